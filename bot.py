@@ -1,7 +1,16 @@
+import io
+try:
+    import ujson as json # Тот же быстрый парсер, который подхватывает telebot
+except ImportError:
+    import json
 import logging
-import html # Для экранирования вывода
-from telebot import TeleBot, types
-from telebot.storage import StateMemoryStorage
+import time
+from telebot import TeleBot, apihelper, types
+from telebot.storage import StateMemoryStorage, StateRedisStorage
+try:
+    from redis import Redis
+except ImportError: # redis нужен только при хранении состояний в Redis
+    Redis = None
 # from telebot.handler_backends import State, StatesGroup
 
 # --- Попытка импорта и проверки DB ---
@@ -10,14 +19,14 @@ try:
     from db import db as imported_db # Импортируем под другим именем
     db = imported_db # Присваиваем глобальной переменной
     # Проверка после импорта
-    if db is None or db.conn is None or db.conn.closed:
+    if db is None or not db.is_healthy():
         raise ImportError("Database connection is not available after import.")
     logger_db_check = logging.getLogger(__name__)
     logger_db_check.info("Database object imported and connection verified successfully.")
 except Exception as e:
     logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logger = logging.getLogger(__name__)
-    logger.critical(f"CRITICAL ERROR: Could not import or verify database connection. Bot cannot start. Error: {e}", exc_info=True)
+    logger.critical("CRITICAL ERROR: Could not import or verify database connection. Bot cannot start. Error: %s", e, exc_info=True)
     db = None # Явно ставим None, чтобы проверки ниже работали
 
 # --- Импорт конфигурации ---
@@ -28,7 +37,7 @@ if db: # Только если db успешно импортирован
         if not BOT_TOKEN:
              raise ValueError("BOT_TOKEN is empty or not set in config.py")
     except (ImportError, ValueError, Exception) as config_e:
-        logger.critical(f"CRITICAL ERROR: Failed to load BOT_TOKEN from config: {config_e}", exc_info=True)
+        logger.critical("CRITICAL ERROR: Failed to load BOT_TOKEN from config: %s", config_e, exc_info=True)
         db = None # Считаем запуск невозможным
         BOT_TOKEN = None
 
@@ -40,16 +49,66 @@ if not logging.getLogger().hasHandlers():
     )
 logger = logging.getLogger(__name__)
 
+# --- Хранилище состояний ---
+STATE_TTL_SECONDS = 24 * 60 * 60 # Состояния неактивных пользователей живут сутки
+NUM_WORKER_THREADS = 8 # Потоки, в которых telebot выполняет обработчики обновлений
+
+class TTLStateRedisStorage(StateRedisStorage):
+    """
+    StateRedisStorage, записи которого истекают через ttl секунд после последней записи.
+    Чтение и запись переопределены, чтобы использовать ujson: telebot.storage импортирует стандартный json.
+    """
+    def __init__(self, ttl=STATE_TTL_SECONDS, **kwargs):
+        super().__init__(**kwargs)
+        self.ttl = ttl
+
+    def get_record(self, key):
+        connection = Redis(connection_pool=self.redis)
+        result = connection.get(self.prefix + str(key))
+        connection.close()
+        if result: return json.loads(result)
+        return None
+
+    def set_record(self, key, value):
+        connection = Redis(connection_pool=self.redis)
+        connection.set(self.prefix + str(key), json.dumps(value), ex=self.ttl)
+        connection.close()
+        return True
+
+def get_optional_config(name, default=None):
+    """Возвращает необязательный параметр из config.py или default, если он не задан."""
+    import config
+    return getattr(config, name, default)
+
+def create_state_storage():
+    """Создает хранилище состояний: Redis, если задан REDIS_CONFIG, иначе память процесса."""
+    redis_config = get_optional_config('REDIS_CONFIG')
+    if not redis_config:
+        logger.warning("REDIS_CONFIG is not set in config.py. Using StateMemoryStorage (single process only).")
+        return StateMemoryStorage()
+    logger.info("Using Redis state storage.")
+    return TTLStateRedisStorage(**redis_config)
+
+def configure_api_server():
+    """Направляет запросы к Bot API на локальный сервер telegram-bot-api, если задан TELEGRAM_API_URL."""
+    api_url = get_optional_config('TELEGRAM_API_URL')
+    if api_url:
+        api_url = api_url.rstrip('/')
+        apihelper.API_URL = api_url + "/bot{0}/{1}"
+        apihelper.FILE_URL = api_url + "/file/bot{0}/{1}"
+        logger.info("Using Bot API server at %s", api_url)
+
 # --- Инициализация бота (только если все ОК) ---
 bot = None
 if db and BOT_TOKEN:
     logger.info("Initializing TeleBot...")
     try:
-        state_storage = StateMemoryStorage()
-        bot = TeleBot(BOT_TOKEN, state_storage=state_storage, parse_mode='HTML')
+        configure_api_server()
+        state_storage = create_state_storage()
+        bot = TeleBot(BOT_TOKEN, state_storage=state_storage, parse_mode='HTML', threaded=True, num_threads=NUM_WORKER_THREADS)
         logger.info("TeleBot initialized successfully.")
     except Exception as bot_init_err:
-         logger.critical(f"CRITICAL ERROR: Failed to initialize TeleBot: {bot_init_err}", exc_info=True)
+         logger.critical("CRITICAL ERROR: Failed to initialize TeleBot: %s", bot_init_err, exc_info=True)
          bot = None # Считаем запуск невозможным
 else:
     logger.critical("Bot initialization skipped due to previous critical errors (DB or Config).")
@@ -59,25 +118,100 @@ else:
 BUTTON_NEXT_CARD = "Дальше ▶▶"
 BUTTON_ADD_WORD = "Добавить слово +"
 BUTTON_DELETE_WORD = "Удалить слово"
+WORDS_PAGE_SIZE = 100 # Слов на странице /my_words (укладывается в лимит сообщения 4096 символов)
+MESSAGE_SAFE_LIMIT = 4000 # Символов списка в одном сообщении, с запасом под хвост до лимита 4096
+
+# Экранирование пользовательского текста для parse_mode='HTML' (те же замены, что html.escape),
+# str.translate делает все замены за один проход по строке
+_HTML_ESC_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+# --- Тексты сообщений ---
+WELCOME_TEXT = """
+🎓 <b>Английский с ботом - легко!</b>
+
+Привет! Я помогу тебе выучить новые английские слова.
+Базовый набор слов уже доступен.
+
+<b>Команды:</b>
+/cards - Начать тренировку 🧠
+/add_word - Добавить свое слово ➕
+/delete_word - Удалить свое слово ➖
+/my_words - Показать мои слова 📖
+/stats - Моя статистика 📊
+/input_mode - Выбрать режим ввода ответа ⌨️
+/help - Показать это сообщение помощи ℹ️
+"""
+
+INPUT_MODE_DESCRIPTION = (
+    "🔘 <b>Кнопки:</b> Показываются варианты ответа.\n"
+    "⌨️ <b>Клавиатура:</b> Нужно ввести перевод самостоятельно."
+)
+INPUT_MODE_TEXT = f"⚙️ <b>Выберите режим ввода ответа:</b>\n\n{INPUT_MODE_DESCRIPTION}"
+INPUT_MODE_UPDATED_TEXTS = {
+    mode: f"⚙️ <b>Режим ввода обновлен.</b>\n\nВыбран режим: <b>{title}</b>\n\n{INPUT_MODE_DESCRIPTION}"
+    for mode, title in (('buttons', 'Кнопки 🔘'), ('keyboard', 'Клавиатура ⌨️'))
+}
+
+STATS_EMPTY_TEMPLATE = (
+    "📊 <b>Статистика:</b>\n\n"
+    "Вы еще не отвечали!\n"
+    "📖 Добавлено вами: {user_words}\n"
+    "📚 Всего доступно: {available_words}\n\n"
+    "Начните: /cards"
+)
+STATS_TEMPLATE = """
+📊 <b>Статистика:</b>
+🧠 Слов с ответами: {words_practiced}
+✅ Всего правильных: {total_correct}
+❌ Всего неправильных: {total_incorrect}
+🎯 Точность: {accuracy:.1f}%
+
+📖 Добавлено вами: {user_words}
+📚 Всего доступно: {available_words}
+"""
+
+ADD_WORD_FOOTER = "Что дальше? /cards, /add_word, /my_words"
+DELETE_WORD_FOOTER = "Что дальше? /cards, /delete_word, /my_words"
+
+# --- Заранее собранные клавиатуры ---
+# Служебные ряды под вариантами ответа (в формате, который хранит ReplyKeyboardMarkup.keyboard)
+_CARD_BOTTOM_ROWS = [
+    [types.KeyboardButton(BUTTON_NEXT_CARD).to_dict(), types.KeyboardButton(BUTTON_ADD_WORD).to_dict()],
+    [types.KeyboardButton(BUTTON_DELETE_WORD).to_dict()],
+]
+
+def build_input_mode_markup(current_mode):
+    """Строит Inline клавиатуру выбора режима ввода с отметкой текущего режима."""
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    button_text_buttons = f"{'✅ ' if current_mode == 'buttons' else ''}Кнопки 🔘"
+    button_text_keyboard = f"{'✅ ' if current_mode == 'keyboard' else ''}Клавиатура ⌨️"
+    markup.add(
+        types.InlineKeyboardButton(button_text_buttons, callback_data="set_mode_buttons"),
+        types.InlineKeyboardButton(button_text_keyboard, callback_data="set_mode_keyboard")
+    )
+    return markup
+
+_INPUT_MODE_MARKUPS = {mode: build_input_mode_markup(mode) for mode in ('buttons', 'keyboard')}
 
 # --- Проверка доступности бота ---
 def is_bot_available(message_or_call):
     """Проверяет, инициализирован ли бот и доступна ли БД."""
+    # Быстрый путь: флаг db.healthy сбрасывает сам слой БД при потере соединения
+    if bot is not None and db is not None and db.healthy:
+        return True
+
     is_call = isinstance(message_or_call, types.CallbackQuery)
     user_id = message_or_call.from_user.id
-
-    if bot is None or db is None or db.conn is None or db.conn.closed:
-        logger.error(f"Bot or DB unavailable. Request from user {user_id}")
-        try:
-            if bot: # Если объект бота еще существует
-                if is_call:
-                    bot.answer_callback_query(message_or_call.id, "😔 Бот временно недоступен", show_alert=True)
-                else:
-                    bot.reply_to(message_or_call, "😔 Бот временно недоступен из-за внутренней ошибки. Пожалуйста, попробуйте позже.")
-        except Exception as send_err:
-             logger.error(f"Could not even send unavailability message: {send_err}")
-        return False
-    return True
+    logger.error("Bot or DB unavailable. Request from user %s", user_id)
+    try:
+        if bot: # Если объект бота еще существует
+            if is_call:
+                bot.answer_callback_query(message_or_call.id, "😔 Бот временно недоступен", show_alert=True)
+            else:
+                bot.reply_to(message_or_call, "😔 Бот временно недоступен из-за внутренней ошибки. Пожалуйста, попробуйте позже.")
+    except Exception as send_err:
+         logger.error("Could not even send unavailability message: %s", send_err)
+    return False
 
 # --- Обработчики команд ---
 
@@ -89,37 +223,21 @@ def send_welcome(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     command = message.text.strip('/')
-    logger.info(f"User {user_id} used /{command}")
+    logger.info("User %s used /%s", user_id, command)
 
     # Сброс состояния пользователя
     try:
        bot.set_state(user_id, state=None, chat_id=chat_id)
        with bot.retrieve_data(user_id, chat_id) as data: data.clear()
-       logger.debug(f"Cleared state and data for user {user_id}")
+       logger.debug("Cleared state and data for user %s", user_id)
     except Exception as e:
-       logger.error(f"Error clearing state/data for user {user_id} in /{command}: {e}", exc_info=True)
-
-    # Приветственное сообщение
-    welcome_text = """
-🎓 <b>Английский с ботом - легко!</b>
-
-Привет! Я помогу тебе выучить новые английские слова.
-Базовый набор слов уже доступен.
+       logger.error("Error clearing state/data for user %s in /%s: %s", user_id, command, e, exc_info=True)
 
-<b>Команды:</b>
-/cards - Начать тренировку 🧠
-/add_word - Добавить свое слово ➕
-/delete_word - Удалить свое слово ➖
-/my_words - Показать мои слова 📖
-/stats - Моя статистика 📊
-/input_mode - Выбрать режим ввода ответа ⌨️
-/help - Показать это сообщение помощи ℹ️
-"""
     try:
         # Убираем клавиатуру от предыдущих действий, если была
-        bot.reply_to(message, welcome_text, reply_markup=types.ReplyKeyboardRemove())
+        bot.reply_to(message, WELCOME_TEXT, reply_markup=types.ReplyKeyboardRemove())
     except Exception as e:
-         logger.error(f"Failed to send welcome message to user {user_id}: {e}", exc_info=True)
+         logger.error("Failed to send welcome message to user %s: %s", user_id, e, exc_info=True)
 
 @bot.message_handler(commands=['cards'])
 def handle_cards(message):
@@ -128,39 +246,41 @@ def handle_cards(message):
 
     user_id = message.from_user.id
     chat_id = message.chat.id
-    logger.info(f"User {user_id} requested /cards")
+    logger.info("User %s requested /cards", user_id)
 
     try:
         bot.set_state(user_id, state=None, chat_id=chat_id)
-        with bot.retrieve_data(user_id, chat_id) as data: data.clear()
 
         total_words = db.count_total_words(user_id)
         if total_words == 0:
+             bot.reset_data(user_id, chat_id) # Старая карточка больше не ждет ответа
              bot.send_message(chat_id, "📭 Ваш словарь пуст! Добавьте слова: /add_word", reply_markup=types.ReplyKeyboardRemove())
              return
 
         card = db.get_random_card(user_id)
         if card is None:
+             bot.reset_data(user_id, chat_id)
              bot.send_message(chat_id, "⚠️ Не удалось получить карточку. Попробуйте позже.", reply_markup=types.ReplyKeyboardRemove())
-             logger.warning(f"get_random_card returned None for user {user_id}, total_words: {total_words}")
+             logger.warning("get_random_card returned None for user %s, total_words: %s", user_id, total_words)
              return
 
         input_mode = db.get_user_input_mode(user_id)
-        logger.debug(f"User {user_id} input mode: '{input_mode}' for card '{card['en_word']}'")
+        logger.debug("User %s input mode: '%s' for card '%s'", user_id, input_mode, card['en_word'])
 
-        card_data_to_store = {'correct_answer': card['en_word'], 'word_type': card['word_type'], 'word_ref_id': card['word_ref_id']}
-        message_text = f"🇷🇺 {html.escape(card['ru_word'])}" # Текст вопроса общий
+        card_data_to_store = {
+            'correct_answer': card['en_word'],
+            'correct_answer_cf': card['en_word'].casefold(), # Для сравнения с ответом без учета регистра
+            'word_type': card['word_type'], 'word_ref_id': card['word_ref_id']
+        }
+        message_text = f"🇷🇺 {card['ru_word'].translate(_HTML_ESC_TABLE)}" # Текст вопроса общий
 
         reply_markup = None # По умолчанию клавиатуры нет
         if input_mode == 'buttons':
             message_text = f"🤔 <b>Выбери перевод слова:</b>\n{message_text}"
             markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
             options = card['options']
-            option_buttons = [types.KeyboardButton(word) for word in options]
-            rows = [option_buttons[i:i + 2] for i in range(0, len(option_buttons), 2)]
-            for row in rows: markup.row(*row)
-            markup.row(types.KeyboardButton(BUTTON_NEXT_CARD), types.KeyboardButton(BUTTON_ADD_WORD))
-            markup.row(types.KeyboardButton(BUTTON_DELETE_WORD))
+            # Варианты по два в ряд + заранее собранные служебные ряды
+            markup.keyboard = [[{'text': word} for word in options[i:i + 2]] for i in range(0, len(options), 2)] + _CARD_BOTTOM_ROWS
             reply_markup = markup
 
         elif input_mode == 'keyboard':
@@ -168,18 +288,23 @@ def handle_cards(message):
             reply_markup = types.ReplyKeyboardRemove() # Убираем предыдущую клавиатуру
 
         else: # Неизвестный режим - используем безопасный вариант
-             logger.error(f"Unknown input mode '{input_mode}' for user {user_id}. Defaulting to keyboard.")
+             logger.error("Unknown input mode '%s' for user %s. Defaulting to keyboard.", input_mode, user_id)
              message_text = f"📝 <b>Введите перевод слова (режим по умолчанию):</b>\n{message_text}"
              reply_markup = types.ReplyKeyboardRemove()
 
-        bot.send_message(chat_id, message_text, reply_markup=reply_markup)
-
+        # Одно обращение к хранилищу: убираем старую карточку/шаг и сохраняем новую.
+        # Сохраняем до отправки, чтобы быстрый ответ пользователя уже застал карточку.
         with bot.retrieve_data(user_id, chat_id) as data:
+            data.clear()
             data.update(card_data_to_store)
-        logger.debug(f"Stored card data for user {user_id}: {card_data_to_store}")
+        logger.debug("Stored card data for user %s: %s", user_id, card_data_to_store)
+
+        bot.send_message(chat_id, message_text, reply_markup=reply_markup)
 
     except Exception as e:
-        logger.error(f"Error in handle_cards for user {user_id}: {e}", exc_info=True)
+        logger.error("Error in handle_cards for user %s: %s", user_id, e, exc_info=True)
+        try: bot.reset_data(user_id, chat_id) # Старая карточка или шаг добавления/удаления не должны ждать ответа
+        except Exception as reset_err: logger.error("Could not reset card data for user %s: %s", user_id, reset_err)
         bot.send_message(chat_id, "⚠️ Произошла ошибка при получении карточки. Попробуйте /cards еще раз.", reply_markup=types.ReplyKeyboardRemove())
 
 
@@ -189,25 +314,17 @@ def handle_input_mode_command(message):
     if not is_bot_available(message): return
     user_id = message.from_user.id
     chat_id = message.chat.id
-    logger.info(f"User {user_id} requested /input_mode")
+    logger.info("User %s requested /input_mode", user_id)
     try:
         current_mode = db.get_user_input_mode(user_id)
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        button_text_buttons = f"{'✅ ' if current_mode == 'buttons' else ''}Кнопки 🔘"
-        button_text_keyboard = f"{'✅ ' if current_mode == 'keyboard' else ''}Клавиатура ⌨️"
-        markup.add(
-            types.InlineKeyboardButton(button_text_buttons, callback_data="set_mode_buttons"),
-            types.InlineKeyboardButton(button_text_keyboard, callback_data="set_mode_keyboard")
-        )
+        markup = _INPUT_MODE_MARKUPS.get(current_mode) or build_input_mode_markup(current_mode)
         bot.send_message(
             chat_id,
-            "⚙️ <b>Выберите режим ввода ответа:</b>\n\n"
-            "🔘 <b>Кнопки:</b> Показываются варианты ответа.\n"
-            "⌨️ <b>Клавиатура:</b> Нужно ввести перевод самостоятельно.",
+            INPUT_MODE_TEXT,
             reply_markup=markup
         )
     except Exception as e:
-        logger.error(f"Error handling /input_mode for user {user_id}: {e}", exc_info=True)
+        logger.error("Error handling /input_mode for user %s: %s", user_id, e, exc_info=True)
         bot.send_message(chat_id, "❌ Ошибка отображения настроек.")
 
 
@@ -220,40 +337,31 @@ def callback_set_input_mode(call):
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     requested_mode = call.data.replace('set_mode_', '') # 'buttons' или 'keyboard'
-    logger.info(f"User {user_id} requested set mode to '{requested_mode}' via callback.")
+    logger.info("User %s requested set mode to '%s' via callback.", user_id, requested_mode)
 
     if requested_mode not in ('buttons', 'keyboard'):
-        logger.warning(f"Invalid mode '{requested_mode}' in callback data from user {user_id}.")
+        logger.warning("Invalid mode '%s' in callback data from user %s.", requested_mode, user_id)
         bot.answer_callback_query(call.id, "Ошибка: Неверный режим", show_alert=True)
         return
 
     try:
         success = db.set_user_input_mode(user_id, requested_mode)
         if success:
-            new_markup = types.InlineKeyboardMarkup(row_width=1)
-            button_text_buttons = f"{'✅ ' if requested_mode == 'buttons' else ''}Кнопки 🔘"
-            button_text_keyboard = f"{'✅ ' if requested_mode == 'keyboard' else ''}Клавиатура ⌨️"
-            confirmation_text = f"Выбран режим: <b>{'Кнопки 🔘' if requested_mode == 'buttons' else 'Клавиатура ⌨️'}</b>"
-            new_markup.add(
-                types.InlineKeyboardButton(button_text_buttons, callback_data="set_mode_buttons"),
-                types.InlineKeyboardButton(button_text_keyboard, callback_data="set_mode_keyboard")
-            )
+            new_markup = _INPUT_MODE_MARKUPS[requested_mode]
             bot.edit_message_text(
                 chat_id=chat_id, message_id=message_id,
-                text=f"⚙️ <b>Режим ввода обновлен.</b>\n\n{confirmation_text}\n\n"
-                     "🔘 <b>Кнопки:</b> Показываются варианты ответа.\n"
-                     "⌨️ <b>Клавиатура:</b> Нужно ввести перевод самостоятельно.",
+                text=INPUT_MODE_UPDATED_TEXTS[requested_mode],
                 reply_markup=new_markup
             )
             bot.answer_callback_query(call.id) # Убираем часики
-            logger.info(f"Mode updated to '{requested_mode}' for user {user_id}. Message edited.")
+            logger.info("Mode updated to '%s' for user %s. Message edited.", requested_mode, user_id)
         else:
             bot.answer_callback_query(call.id, "Ошибка сохранения настройки!", show_alert=True)
-            logger.error(f"Failed to set mode '{requested_mode}' in DB for user {user_id}.")
+            logger.error("Failed to set mode '%s' in DB for user %s.", requested_mode, user_id)
     except Exception as e:
-        logger.error(f"Error processing set_mode callback for user {user_id}: {e}", exc_info=True)
+        logger.error("Error processing set_mode callback for user %s: %s", user_id, e, exc_info=True)
         try: bot.answer_callback_query(call.id, "Произошла ошибка!", show_alert=True)
-        except Exception as ans_err: logger.error(f"Could not answer callback query about error: {ans_err}")
+        except Exception as ans_err: logger.error("Could not answer callback query about error: %s", ans_err)
 
 
 @bot.message_handler(content_types=['text'], func=lambda message: bot is not None and not message.text.startswith('/'))
@@ -264,76 +372,69 @@ def handle_non_command_text(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     user_text = message.text.strip()
-    logger.debug(f"Received text '{user_text}' from user {user_id}")
+    logger.debug("Received text '%s' from user %s", user_text, user_id)
 
-    # 1. Проверка кнопок ReplyKeyboard
-    if user_text == BUTTON_NEXT_CARD:
-        logger.info(f"User {user_id} clicked '{BUTTON_NEXT_CARD}'.")
-        handle_cards(message)
-        return
-    if user_text == BUTTON_ADD_WORD:
-        logger.info(f"User {user_id} clicked '{BUTTON_ADD_WORD}'.")
-        start_adding_word_process(message)
-        return
-    if user_text == BUTTON_DELETE_WORD:
-        logger.info(f"User {user_id} clicked '{BUTTON_DELETE_WORD}'.")
-        start_deleting_word_process(message)
+    # 1. Проверка кнопок ReplyKeyboard (один поиск в словаре вместо сравнения с каждой кнопкой)
+    button_handler = _BUTTON_DISPATCH.get(user_text)
+    if button_handler is not None:
+        logger.info("User %s clicked '%s'.", user_id, user_text)
+        button_handler(message)
         return
 
     # 2. Проверка состояний ожидания ввода (add/delete)
     try:
+        # Забираем данные одним коротким обращением к хранилищу, сетевые вызовы - уже после него.
+        # Шаг и карточка снимаются сразу: один ввод обрабатывается только один раз.
         with bot.retrieve_data(user_id, chat_id) as data:
-            if data is None: logger.warning(f"Data is None for user {user_id}"); return
-
-            current_step = data.get('next_step')
-            if current_step == 'add_word':
-                logger.info(f"Processing input for 'add_word'.")
-                data.pop('next_step', None); bot.set_state(user_id, state=None, chat_id=chat_id)
-                process_word_addition(message)
-                return
-            elif current_step == 'delete_word':
-                logger.info(f"Processing input for 'delete_word'.")
-                data.pop('next_step', None); bot.set_state(user_id, state=None, chat_id=chat_id)
-                process_word_deletion(message)
-                return
-
-            # 3. Проверка ответа на карточку
-            correct_answer = data.get('correct_answer')
-            word_type = data.get('word_type')
-            word_ref_id = data.get('word_ref_id')
-
-            if correct_answer is None or word_type is None or word_ref_id is None:
-                 logger.debug(f"Received text '{user_text}' from user {user_id}, but no active card data or expected step.")
-                 # Можно отправить "Используйте /cards или /help"
-                 return
-
-            # --- Обработка ответа на карточку ---
-            is_correct = user_text.lower() == correct_answer.lower()
-            logger.info(f"User {user_id} answered card. Input: '{user_text}', Correct: '{correct_answer}', Result: {is_correct}")
-
-            # Формируем ответ
-            input_mode = db.get_user_input_mode(user_id) # Получаем режим для подсказки
-            next_action_prompt = f"Нажмите '{BUTTON_NEXT_CARD}'" if input_mode == 'buttons' else "Используйте /cards"
-
-            if is_correct:
-                reply = f"✅ <b>Верно!</b>\n\n{next_action_prompt}, чтобы продолжить."
-            else:
-                reply = f"❌ <b>Неверно!</b> Правильно: <b>{html.escape(correct_answer)}</b>\n\n{next_action_prompt}, чтобы продолжить."
+            if data is None: logger.warning("Data is None for user %s", user_id); return
+            snapshot = dict(data)
+            for key in ('next_step', 'correct_answer', 'correct_answer_cf', 'word_type', 'word_ref_id'):
+                data.pop(key, None)
+
+        current_step = snapshot.get('next_step')
+        if current_step == 'add_word':
+            logger.info("Processing input for 'add_word'.")
+            bot.set_state(user_id, state=None, chat_id=chat_id)
+            process_word_addition(message)
+            return
+        elif current_step == 'delete_word':
+            logger.info("Processing input for 'delete_word'.")
+            bot.set_state(user_id, state=None, chat_id=chat_id)
+            process_word_deletion(message)
+            return
+
+        # 3. Проверка ответа на карточку
+        correct_answer = snapshot.get('correct_answer')
+        word_type = snapshot.get('word_type')
+        word_ref_id = snapshot.get('word_ref_id')
+
+        if correct_answer is None or word_type is None or word_ref_id is None:
+             logger.debug("Received text '%s' from user %s, but no active card data or expected step.", user_text, user_id)
+             # Можно отправить "Используйте /cards или /help"
+             return
 
-            # Отправляем результат (клавиатура зависит от режима, не меняем ее здесь)
-            bot.send_message(chat_id, reply)
+        # --- Обработка ответа на карточку ---
+        correct_answer_cf = snapshot.get('correct_answer_cf') or correct_answer.casefold() # Карточки, сохраненные до появления ключа
+        is_correct = user_text.casefold() == correct_answer_cf
+        logger.info("User %s answered card. Input: '%s', Correct: '%s', Result: %s", user_id, user_text, correct_answer, is_correct)
 
-            # Записываем результат в БД
-            db.record_answer(user_id, word_type, word_ref_id, is_correct)
+        # Формируем ответ
+        input_mode = db.get_user_input_mode(user_id) # Получаем режим для подсказки
+        next_action_prompt = f"Нажмите '{BUTTON_NEXT_CARD}'" if input_mode == 'buttons' else "Используйте /cards"
 
-            # Очищаем данные *только* этой карточки из data
-            data.pop('correct_answer', None)
-            data.pop('word_type', None)
-            data.pop('word_ref_id', None)
-            logger.debug(f"Cleared card data for user {user_id} after recording answer.")
+        if is_correct:
+            reply = f"✅ <b>Верно!</b>\n\n{next_action_prompt}, чтобы продолжить."
+        else:
+            reply = f"❌ <b>Неверно!</b> Правильно: <b>{correct_answer.translate(_HTML_ESC_TABLE)}</b>\n\n{next_action_prompt}, чтобы продолжить."
+
+        # Отправляем результат (клавиатура зависит от режима, не меняем ее здесь)
+        bot.send_message(chat_id, reply)
+
+        # Результат попадает в буфер ответов БД и записывается в фоне
+        db.record_answer(user_id, word_type, word_ref_id, is_correct)
 
     except Exception as e:
-        logger.error(f"Error processing non-command text for user {user_id}: {e}", exc_info=True)
+        logger.error("Error processing non-command text for user %s: %s", user_id, e, exc_info=True)
         bot.send_message(chat_id, "⚠️ Произошла ошибка при обработке вашего ответа.")
 
 
@@ -343,15 +444,15 @@ def start_adding_word_process(message):
     """Начинает процесс добавления слова."""
     if not is_bot_available(message): return
     user_id = message.from_user.id; chat_id = message.chat.id
-    logger.info(f"Starting add word process for user {user_id}")
+    logger.info("Starting add word process for user %s", user_id)
     try:
        bot.set_state(user_id, state=None, chat_id=chat_id)
        with bot.retrieve_data(user_id, chat_id) as data:
            data.clear(); data['next_step'] = 'add_word'
-       logger.debug(f"Set 'next_step' to 'add_word' for user {user_id}")
+       logger.debug("Set 'next_step' to 'add_word' for user %s", user_id)
        bot.send_message(chat_id, "📝 Введите: <code>англ. слово - рус. перевод</code>\n(Пример: <code>example - пример</code>)", reply_markup=types.ReplyKeyboardRemove())
     except Exception as e:
-       logger.error(f"Error starting add word process for user {user_id}: {e}", exc_info=True)
+       logger.error("Error starting add word process for user %s: %s", user_id, e, exc_info=True)
        bot.send_message(chat_id, "❌ Ошибка. Попробуйте /add_word снова.")
 
 def process_word_addition(message):
@@ -364,30 +465,29 @@ def process_word_addition(message):
         if not en_word or not ru_word: raise ValueError("Английское или русское слово пустое")
 
         added = db.add_user_word(user_id, en_word, ru_word)
-        en_safe, ru_safe = html.escape(en_word), html.escape(ru_word)
+        en_safe, ru_safe = en_word.translate(_HTML_ESC_TABLE), ru_word.translate(_HTML_ESC_TABLE)
         reply = f"✅ Добавлено: <code>{en_safe} - {ru_safe}</code>!" if added else f"⚠️ Слово <code>{en_safe}</code> уже есть."
-        bot.send_message(chat_id, reply)
-        bot.send_message(chat_id, "Что дальше? /cards, /add_word, /my_words")
+        bot.send_message(chat_id, f"{reply}\n\n{ADD_WORD_FOOTER}")
     except ValueError as ve:
-        logger.warning(f"User {user_id} add format error: '{text}' - {ve}")
+        logger.warning("User %s add format error: '%s' - %s", user_id, text, ve)
         bot.send_message(chat_id, f"❌ <b>Ошибка формата:</b> {ve}.\nНужно: <code>слово - перевод</code>\nПопробуйте /add_word снова.")
     except Exception as e:
-        logger.error(f"Error processing word addition for user {user_id}, input '{text}': {e}", exc_info=True)
+        logger.error("Error processing word addition for user %s, input '%s': %s", user_id, text, e, exc_info=True)
         bot.send_message(chat_id, "❌ Ошибка добавления слова. Попробуйте позже.")
 
 def start_deleting_word_process(message):
     """Начинает процесс удаления слова."""
     if not is_bot_available(message): return
     user_id = message.from_user.id; chat_id = message.chat.id
-    logger.info(f"Starting delete word process for user {user_id}")
+    logger.info("Starting delete word process for user %s", user_id)
     try:
        bot.set_state(user_id, state=None, chat_id=chat_id)
        with bot.retrieve_data(user_id, chat_id) as data:
            data.clear(); data['next_step'] = 'delete_word'
-       logger.debug(f"Set 'next_step' to 'delete_word' for user {user_id}")
+       logger.debug("Set 'next_step' to 'delete_word' for user %s", user_id)
        bot.send_message(chat_id, "🗑️ Введите английское слово для удаления:", reply_markup=types.ReplyKeyboardRemove())
     except Exception as e:
-       logger.error(f"Error starting delete word process for user {user_id}: {e}", exc_info=True)
+       logger.error("Error starting delete word process for user %s: %s", user_id, e, exc_info=True)
        bot.send_message(chat_id, "❌ Ошибка. Попробуйте /delete_word снова.")
 
 def process_word_deletion(message):
@@ -398,13 +498,19 @@ def process_word_deletion(message):
         bot.send_message(chat_id, "❌ Не введено слово. Попробуйте /delete_word снова."); return
     try:
         deleted = db.delete_user_word(user_id, en_word)
-        en_safe = html.escape(en_word)
+        en_safe = en_word.translate(_HTML_ESC_TABLE)
         reply = f"✅ Слово <code>{en_safe}</code> удалено." if deleted else f"⚠️ Слово <code>{en_safe}</code> не найдено в вашем словаре."
-        bot.send_message(chat_id, reply)
-        bot.send_message(chat_id, "Что дальше? /cards, /delete_word, /my_words")
+        bot.send_message(chat_id, f"{reply}\n\n{DELETE_WORD_FOOTER}")
     except Exception as e:
-        logger.error(f"Error processing word deletion for user {user_id}, input '{en_word}': {e}", exc_info=True)
-        bot.send_message(chat_id, f"❌ Ошибка при удалении слова <code>{html.escape(en_word)}</code>.")
+        logger.error("Error processing word deletion for user %s, input '%s': %s", user_id, en_word, e, exc_info=True)
+        bot.send_message(chat_id, f"❌ Ошибка при удалении слова <code>{en_word.translate(_HTML_ESC_TABLE)}</code>.")
+
+# Кнопки ReplyKeyboard -> обработчики (собирается после объявления всех трех функций)
+_BUTTON_DISPATCH = {
+    BUTTON_NEXT_CARD: handle_cards,
+    BUTTON_ADD_WORD: start_adding_word_process,
+    BUTTON_DELETE_WORD: start_deleting_word_process,
+}
 
 
 # --- Обработчики команд add/delete (вызывают start_..._process) ---
@@ -424,22 +530,40 @@ def show_my_words(message):
     """Показывает слова, добавленные пользователем."""
     if not is_bot_available(message): return
     user_id = message.from_user.id; chat_id = message.chat.id
-    logger.info(f"User {user_id} requested /my_words")
     try:
-        user_words = db.get_user_words(user_id)
+        args = message.text.split()[1:]
+        # Аргумент - номер слова, с которого начинать (страницы разной длины из-за лимита на размер сообщения).
+        # isdecimal, а не isdigit: '²' проходит isdigit, но int() его не разбирает
+        start = int(args[0]) if args and args[0].isdecimal() and int(args[0]) > 0 else 1
+        logger.info("User %s requested /my_words, starting from word %s", user_id, start)
+        offset = start - 1
+        # Запрашиваем на одно слово больше, чтобы узнать, есть ли продолжение
+        user_words = db.get_user_words(user_id, limit=WORDS_PAGE_SIZE + 1, offset=offset)
         if not user_words:
+            if start > 1:
+                bot.send_message(chat_id, f"📖 Слов с номером {start} и дальше нет. Начните с /my_words."); return
             bot.send_message(chat_id, "📖 У вас нет добавленных слов. Используйте /add_word."); return
-        response_lines = ["📖 <b>Ваши слова:</b>\n"]
-        for i, (en, ru) in enumerate(user_words, 1):
-             response_lines.append(f"{i}. <code>{html.escape(en)}</code> - {html.escape(ru)}")
-        full_response = "\n".join(response_lines)
-        # TODO: Добавить пагинацию для > 4096 символов
-        if len(full_response) > 4096:
-            safe_limit = full_response.rfind('\n', 0, 4050); safe_limit = 4050 if safe_limit == -1 else safe_limit
-            full_response = full_response[:safe_limit] + "\n\n[... список слишком длинный ...]"
-        bot.send_message(chat_id, full_response)
+        buf = io.StringIO()
+        length = 0
+        shown = 0
+        for i, (en, ru) in enumerate(user_words[:WORDS_PAGE_SIZE], start):
+            line = f"\n{i}. <code>{en.translate(_HTML_ESC_TABLE)}</code> - {ru.translate(_HTML_ESC_TABLE)}"
+            if length + len(line) > MESSAGE_SAFE_LIMIT - 100: # Запас на заголовок и ссылку на продолжение
+                break
+            buf.write(line)
+            length += len(line)
+            shown += 1
+        # Продолжение начинается сразу после последнего показанного слова, а не после всех запрошенных
+        next_start = start + shown if shown < len(user_words) else None
+        if start > 1 or next_start:
+            header = f"📖 <b>Ваши слова</b> ({start}–{start + shown - 1}):\n"
+        else:
+            header = "📖 <b>Ваши слова:</b>\n"
+        if next_start:
+            buf.write(f"\n\nДальше: /my_words {next_start}")
+        bot.send_message(chat_id, header + buf.getvalue())
     except Exception as e:
-        logger.error(f"Error showing user words for user {user_id}: {e}", exc_info=True)
+        logger.error("Error showing user words for user %s: %s", user_id, e, exc_info=True)
         bot.send_message(chat_id, "❌ Ошибка получения списка слов.")
 
 @bot.message_handler(commands=['stats'])
@@ -447,51 +571,62 @@ def show_stats(message):
     """Показывает статистику пользователя."""
     if not is_bot_available(message): return
     user_id = message.from_user.id; chat_id = message.chat.id
-    logger.info(f"User {user_id} requested /stats")
+    logger.info("User %s requested /stats", user_id)
     try:
-        stats = db.get_user_stats(user_id)
-        user_words_count = len(db.get_user_words(user_id))
-        available_words_count = db.count_total_words(user_id)
+        stats = db.get_stats_bundle(user_id)
         if stats['words_practiced'] == 0 and stats['total_correct'] == 0 and stats['total_incorrect'] == 0:
-             response = (f"📊 <b>Статистика:</b>\n\n"
-                         f"Вы еще не отвечали!\n"
-                         f"📖 Добавлено вами: {user_words_count}\n"
-                         f"📚 Всего доступно: {available_words_count}\n\n"
-                         f"Начните: /cards")
+             response = STATS_EMPTY_TEMPLATE.format_map(stats)
         else:
             total_answers = stats['total_correct'] + stats['total_incorrect']
-            accuracy = (stats['total_correct'] / total_answers * 100) if total_answers > 0 else 0
-            response = f"""
-📊 <b>Статистика:</b>
-🧠 Слов с ответами: {stats['words_practiced']}
-✅ Всего правильных: {stats['total_correct']}
-❌ Всего неправильных: {stats['total_incorrect']}
-🎯 Точность: {accuracy:.1f}%
-
-📖 Добавлено вами: {user_words_count}
-📚 Всего доступно: {available_words_count}
-"""
+            stats['accuracy'] = (stats['total_correct'] / total_answers * 100) if total_answers > 0 else 0
+            response = STATS_TEMPLATE.format_map(stats)
         bot.send_message(chat_id, response)
     except Exception as e:
-        logger.error(f"Error showing stats for user {user_id}: {e}", exc_info=True)
+        logger.error("Error showing stats for user %s: %s", user_id, e, exc_info=True)
         bot.send_message(chat_id, "❌ Ошибка получения статистики.")
 
 # --- Запуск бота ---
+REMOVE_WEBHOOK_ATTEMPTS = 5
+REMOVE_WEBHOOK_RETRY_DELAY = 3 # секунд, как между попытками infinity_polling
+
+def remove_webhook_with_retry():
+    """
+    Снимает webhook перед запуском опроса, повторяя попытку при временных ошибках
+    (сеть, еще не запущенный локальный Bot API сервер). Если не удалось - опрос все равно запускается.
+    """
+    for attempt in range(1, REMOVE_WEBHOOK_ATTEMPTS + 1):
+        try:
+            bot.remove_webhook()
+            return
+        except Exception as e:
+            logger.warning("Could not remove webhook (attempt %s/%s): %s", attempt, REMOVE_WEBHOOK_ATTEMPTS, e)
+            if attempt < REMOVE_WEBHOOK_ATTEMPTS:
+                time.sleep(REMOVE_WEBHOOK_RETRY_DELAY)
+    logger.error("Failed to remove webhook, starting polling anyway.")
+
 if __name__ == "__main__":
     if bot is None:
-        logger.critical("Bot object is None. Cannot start polling. Check logs for DB or Config errors.")
+        logger.critical("Bot object is None. Cannot start. Check logs for DB or Config errors.")
     else:
-        logger.info("Starting bot polling...")
+        webhook_config = get_optional_config('WEBHOOK_CONFIG')
         try:
-            # Добавляем обработку KeyboardInterrupt для корректной остановки Ctrl+C
-            bot.infinity_polling(logger_level=logging.INFO, timeout=60, long_polling_timeout=30)
+            if webhook_config:
+                # Telegram сам присылает обновления, обработчики выполняются в пуле потоков бота
+                logger.info("Starting bot webhook listener...")
+                bot.run_webhooks(**webhook_config)
+            else:
+                logger.info("Starting bot polling...")
+                remove_webhook_with_retry() # Опрос невозможен, пока установлен webhook
+                # Добавляем обработку KeyboardInterrupt для корректной остановки Ctrl+C
+                # Обработчики выполняются в пуле потоков бота, поток опроса не ждет медленных запросов к БД
+                bot.infinity_polling(logger_level=logging.INFO, skip_pending=False, timeout=60, long_polling_timeout=30)
         except KeyboardInterrupt:
-             logger.info("Bot polling stopped manually via KeyboardInterrupt.")
+             logger.info("Bot stopped manually via KeyboardInterrupt.")
         except Exception as e:
-            logger.critical(f"Bot polling stopped due to unexpected error: {e}", exc_info=True)
+            logger.critical("Bot stopped due to unexpected error: %s", e, exc_info=True)
         finally:
             # Корректное закрытие соединения с БД при остановке
-            if db and db.conn and not db.conn.closed:
-                logger.info("Closing database connection...")
-                db.close()
+            if db and db.is_healthy():
+                logger.info("Closing database connection pool...")
+                db.close_all()
             logger.info("Bot stopped.")
\ No newline at end of file
@@ -1,37 +1,276 @@
-import psycopg2
-import psycopg2.errors
+try:
+    import psycopg2
+except ImportError: # PyPy: psycopg2cffi реализует тот же API под именем psycopg2
+    from psycopg2cffi import compat
+    compat.register()
+    import psycopg2
+import psycopg2.errorcodes # psycopg2.errors нет в psycopg2cffi, поэтому ошибки различаем по pgcode
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+import csv
+import io
 import random
+import select
 import logging
-from datetime import datetime, timezone # Импортируем datetime и timezone для TIMESTAMPTZ
+import threading
+import time
+from contextlib import contextmanager
 from config import DB_CONFIG
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Вес слова при выборе карточки (p - строка user_word_progress, NULL для нового слова)
+CARD_WEIGHT_SQL = """CASE
+                WHEN COALESCE(p.correct_count, 0) = 0 AND COALESCE(p.incorrect_count, 0) = 0 THEN 10
+                WHEN p.incorrect_count > 0 THEN GREATEST(1, 5 + p.incorrect_count * 2 - p.correct_count)
+                ELSE GREATEST(1, 5 - p.correct_count)
+            END"""
+
+# Запросы горячего пути: разбираются и планируются сервером один раз на соединение (PREPARE),
+# далее выполняются через EXECUTE без повторного разбора текста
+PREPARED_STATEMENTS = {
+    # Взвешенный случайный выбор одной карточки (A-Res): у каждого слова ключ -ln(u)/вес, берется минимальный.
+    # Веса: новое слово - 10, слово с ошибками - 5 + 2*ошибки - верные, остальные - 5 - верные (не меньше 1).
+    # В том же запросе выбираются до трех случайных неправильных вариантов ответа
+    'get_random_card': f"""
+        PREPARE get_random_card (bigint) AS
+        WITH target AS (
+            SELECT w.en_word, w.ru_word, w.word_type, w.word_ref_id
+            FROM (
+                SELECT en_word, ru_word, 'common' AS word_type, id AS word_ref_id FROM common_words
+                UNION ALL
+                SELECT en_word, ru_word, 'user' AS word_type, id AS word_ref_id FROM user_words WHERE user_id = $1
+            ) AS w
+            LEFT JOIN user_word_progress p ON w.word_ref_id = p.word_ref_id
+                                           AND w.word_type = p.word_type
+                                           AND p.user_id = $1
+            ORDER BY -ln(1 - random()) / {CARD_WEIGHT_SQL}
+            LIMIT 1
+        )
+        SELECT t.en_word, t.ru_word, t.word_type, t.word_ref_id,
+            ARRAY(
+                SELECT o.en_word FROM (
+                    SELECT en_word FROM common_words c
+                    WHERE NOT EXISTS (SELECT 1 FROM user_words u WHERE u.user_id = $1 AND u.en_word = c.en_word)
+                    UNION ALL
+                    SELECT en_word FROM user_words WHERE user_id = $1
+                ) AS o
+                WHERE o.en_word <> t.en_word
+                ORDER BY random()
+                LIMIT 3
+            )
+        FROM target t
+    """,
+    # Упрощенные варианты для пользователей без своих слов: без ветки user_words,
+    # неправильные варианты берутся из закэшированного списка общих слов
+    'get_random_common_card': f"""
+        PREPARE get_random_common_card (bigint) AS
+        WITH target AS (
+            SELECT c.en_word, c.ru_word, 'common' AS word_type, c.id AS word_ref_id
+            FROM common_words c
+            LEFT JOIN user_word_progress p ON c.id = p.word_ref_id
+                                           AND p.word_type = 'common'
+                                           AND p.user_id = $1
+            ORDER BY -ln(1 - random()) / {CARD_WEIGHT_SQL}
+            LIMIT 1
+        )
+        SELECT * FROM target
+    """,
+    'get_common_words': """
+        PREPARE get_common_words AS
+        SELECT en_word FROM common_words
+    """,
+    'has_user_words': """
+        PREPARE has_user_words (bigint) AS
+        SELECT EXISTS (SELECT 1 FROM user_words WHERE user_id = $1)
+    """,
+    'count_total_words': """
+        PREPARE count_total_words (bigint) AS
+        SELECT COUNT(DISTINCT en_word) FROM (
+            SELECT en_word FROM common_words
+            UNION ALL
+            SELECT en_word FROM user_words WHERE user_id = $1
+        ) AS all_words
+    """,
+    # Прибавляет приращения счетчиков к прогрессу; одна пачка ответов передается массивами,
+    # поэтому план один и тот же при любом размере пачки. last_tested - время записи пачки (now() на сервере).
+    # Ответы на уже удаленные свои слова пропускаются, чтобы не оставлять прогресс без слова;
+    # FOR KEY SHARE дожидается завершения идущего удаления слова
+    'record_answers': """
+        PREPARE record_answers (bigint[], varchar[], bigint[], int[], int[]) AS
+        INSERT INTO user_word_progress (user_id, word_type, word_ref_id, correct_count, incorrect_count, last_tested)
+        SELECT a.*, now() FROM unnest($1, $2, $3, $4, $5) AS a(user_id, word_type, word_ref_id, correct_count, incorrect_count)
+        WHERE a.word_type <> 'user'
+           OR EXISTS (SELECT 1 FROM user_words u WHERE u.id = a.word_ref_id AND u.user_id = a.user_id FOR KEY SHARE)
+        ON CONFLICT (user_id, word_type, word_ref_id) DO UPDATE SET
+            correct_count = user_word_progress.correct_count + EXCLUDED.correct_count,
+            incorrect_count = user_word_progress.incorrect_count + EXCLUDED.incorrect_count,
+            last_tested = EXCLUDED.last_tested
+    """,
+    'get_user_input_mode': """
+        PREPARE get_user_input_mode (bigint) AS
+        SELECT input_mode FROM user_preferences WHERE user_id = $1
+    """,
+    'set_user_input_mode': """
+        PREPARE set_user_input_mode (bigint, varchar) AS
+        INSERT INTO user_preferences (user_id, input_mode) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET input_mode = EXCLUDED.input_mode
+    """,
+    'add_user_word': """
+        PREPARE add_user_word (bigint, varchar, varchar) AS
+        INSERT INTO user_words (user_id, en_word, ru_word)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id, en_word) DO NOTHING
+        RETURNING id
+    """,
+}
+
+# Размер пула соединений. Свободные соединения сверх POOL_MIN_CONNECTIONS пул закрывает,
+# поэтому минимум покрывает все потоки бота, чтобы не переподключаться на каждый запрос
+POOL_MIN_CONNECTIONS = 10
+POOL_MAX_CONNECTIONS = 16
+HEALTH_CHECK_INTERVAL = 5 # секунд между проверками восстановления недоступной БД
+ANSWER_FLUSH_SIZE = 100 # Слов в буфере ответов, при котором он записывается сразу
+ANSWER_FLUSH_INTERVAL = 0.5 # секунд от первого ответа в буфере до его записи
+INPUT_MODE_CACHE_TTL = 300 # секунд
+INPUT_MODE_CACHE_MAX = 100_000 # записей, после чего кэш сбрасывается целиком
+STATS_CACHE_TTL = 10 # секунд
+STATS_CACHE_MAX = 100_000 # записей, после чего кэш сбрасывается целиком
+USER_WORDS_FLAG_TTL = 300 # секунд; другой процесс бота мог добавить пользователю слова
+USER_WORDS_FLAG_MAX = 100_000 # записей, после чего кэш сбрасывается целиком
+# Ограничения времени для каждого соединения пула: зависший запрос или транзакция не занимают соединение бесконечно
+SESSION_TIMEOUTS = {
+    'statement_timeout': '3s',
+    'idle_in_transaction_session_timeout': '5s',
+    'lock_timeout': '1s',
+}
+# TCP keepalive по умолчанию (можно переопределить в DB_CONFIG): оборванные соединения обнаруживаются за ~1.5 минуты
+KEEPALIVE_DEFAULTS = {
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 5,
+}
+SCHEMA_LOCK_ID = 4242 # Ключ pg_advisory_lock: схему создает только один процесс бота одновременно
+
+# Схема актуальна: таблицы, ограничение и индексы из init_tables уже есть, устаревшие индексы удалены
+SCHEMA_READY_QUERY = """
+    SELECT to_regclass('user_preferences') IS NOT NULL
+       AND to_regclass('idx_progress_covering') IS NOT NULL
+       AND to_regclass('idx_user_words_user_en') IS NOT NULL
+       AND to_regclass('idx_preferences_user') IS NULL
+       AND EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_user_word')
+       AND EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_common_words_notify')
+"""
+
+# Каналы NOTIFY, по которым процессы бота узнают об изменениях и сбрасывают свои кэши
+USER_CHANGED_CHANNEL = 'user_changed' # payload: "<таблица>:<user_id>"
+COMMON_WORDS_CHANGED_CHANNEL = 'common_words_changed'
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Соединение, которое помнит, выполнены ли в нем PREPARE из PREPARED_STATEMENTS."""
+    statements_prepared = False
+
+class UserCache:
+    """
+    Кэш значений по user_id с ограниченным временем жизни.
+    Значение, прочитанное из БД, сохраняется через store_read только если запись пользователя
+    не изменяли и не сбрасывали, пока шел запрос: иначе в кэш попало бы устаревшее значение.
+    """
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size # Записей, после чего кэш сбрасывается целиком
+        self._items = {} # user_id -> (значение, expires_at)
+        self._changed = {} # user_id -> номер последнего изменения или сброса
+        self._changed_floor = 0 # Номер изменения для пользователей, которых нет в _changed
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Возвращает закэшированное значение или None, если его нет или оно устарело."""
+        with self._lock:
+            cached = self._items.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def begin_read(self):
+        """Номер чтения из БД; передается в store_read вместе с прочитанным значением."""
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def store_read(self, user_id, value, read_id):
+        """Сохраняет прочитанное значение, если запись пользователя не менялась после begin_read."""
+        with self._lock:
+            if max(self._changed.get(user_id, 0), self._changed_floor) < read_id:
+                self._put(user_id, value)
+
+    def set(self, user_id, value):
+        """Сохраняет новое значение после изменения в БД."""
+        with self._lock:
+            self._mark_changed(user_id)
+            self._put(user_id, value)
+
+    def invalidate(self, user_id):
+        """Удаляет значение; оно будет прочитано из БД при следующем обращении."""
+        with self._lock:
+            self._mark_changed(user_id)
+            self._items.pop(user_id, None)
+
+    def clear(self):
+        """Удаляет все значения; начатые до этого чтения не сохраняются."""
+        with self._lock:
+            self._counter += 1
+            self._changed_floor = self._counter
+            self._changed.clear()
+            self._items.clear()
+
+    def _put(self, user_id, value):
+        if len(self._items) >= self.max_size:
+            self._items.clear()
+        self._items[user_id] = (value, time.monotonic() + self.ttl)
+
+    def _mark_changed(self, user_id):
+        self._counter += 1
+        if len(self._changed) >= self.max_size: # Забытые номера заменяет общий: старые чтения все равно отбрасываются
+            self._changed.clear()
+            self._changed_floor = self._counter
+        self._changed[user_id] = self._counter
+
 class Database:
     def __init__(self):
-        self.conn = None
+        self.pool = None
+        self.healthy = True # Сбрасывается при потере соединения, восстанавливается фоновой проверкой
+        self._health_lock = threading.Lock()
+        self._answer_buf = {} # (user_id, word_type, word_ref_id) -> (верные, ошибки)
+        self._answer_lock = threading.Lock()
+        self._flush_timer = None
+        self._input_modes = UserCache(INPUT_MODE_CACHE_TTL, INPUT_MODE_CACHE_MAX)
+        self._stats_cache = UserCache(STATS_CACHE_TTL, STATS_CACHE_MAX) # user_id -> словарь статистики
+        self._user_has_custom = UserCache(USER_WORDS_FLAG_TTL, USER_WORDS_FLAG_MAX) # user_id -> есть ли свои слова
+        self._common_words = None # Кортеж en_word из common_words; None - еще не загружен
+        self._common_words_version = 0 # Увеличивается при каждом сбросе кэша общих слов
+        self._connect_params = None
+        self._listener_stop = threading.Event()
         self.connect()
-        if self.conn:
+        if self.pool:
             try:
-                # Инициализируем все таблицы (включая user_preferences)
-                self.init_tables()
-                logger.info("Table initialization successful.")
-
-                # Загружаем стандартные слова
-                logger.info("Attempting to load/verify initial words...")
-                self.load_initial_words()
-
+                if self._schema_ready():
+                    logger.info("Database schema is up to date, skipping initialization.")
+                else:
+                    self._initialize_schema()
+                threading.Thread(target=self._listen_for_changes, name="db-change-listener", daemon=True).start()
                 logger.info("Database initialization and initial word loading process completed.")
 
             except Exception as e:
                  logger.critical(f"Database initialization process failed: {e}", exc_info=True)
                  try:
-                    if self.conn and not self.conn.closed:
-                        self.conn.close()
+                    self.pool.closeall()
                  except Exception as close_e:
-                    logger.error(f"Error closing connection after initialization failure: {close_e}", exc_info=True)
+                    logger.error(f"Error closing connection pool after initialization failure: {close_e}", exc_info=True)
                  raise
 
         else:
@@ -39,18 +278,188 @@ class Database:
             raise ConnectionError("Database connection failed.")
 
     def connect(self):
-        """Устанавливает соединение с базой данных"""
+        """Создает пул соединений с базой данных"""
         try:
-            self.conn = psycopg2.connect(**DB_CONFIG)
-            self.conn.autocommit = False # Управляем транзакциями явно
-            logger.info("Successfully connected to database")
+            connect_params = self._connect_params = {**KEEPALIVE_DEFAULTS, **DB_CONFIG}
+            # Таймауты передаются при подключении (options), отдельные SET на каждое соединение не нужны
+            timeouts = ' '.join(f"-c {name}={value}" for name, value in SESSION_TIMEOUTS.items())
+            connect_params['options'] = f"{DB_CONFIG.get('options', '')} {timeouts}".strip()
+            # Соединения пула работают с autocommit = False: транзакциями управляем явно
+            self.pool = ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS,
+                connection_factory=PreparingConnection, **connect_params
+            )
+            logger.info("Successfully connected to database (connection pool created)")
         except Exception as e:
             logger.error(f"Connection error: {e}", exc_info=True)
-            self.conn = None
+            self.pool = None
+
+    @contextmanager
+    def _connection(self, prepare=True):
+        """
+        Берет соединение из пула и возвращает его обратно после использования.
+        При ошибке незавершенная транзакция откатывается.
+        prepare=True - перед использованием выполнить в соединении PREPARE (один раз на соединение).
+        """
+        try:
+            conn = self.pool.getconn()
+        except psycopg2.OperationalError as e: # Не удалось открыть новое соединение
+            self._mark_unhealthy(e)
+            raise
+        try:
+            if prepare and not conn.statements_prepared:
+                self._prepare_statements(conn)
+            yield conn
+        except Exception as e:
+            if conn.closed: # Соединение потеряно во время запроса
+                self._mark_unhealthy(e)
+            else:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    @contextmanager
+    def _cursor(self, prepare=True, timeouts=True):
+        """
+        Выдает курсор соединения из пула. Транзакция фиксируется, если блок завершился без ошибок,
+        иначе откатывается; соединение возвращается в пул в любом случае.
+        timeouts=False - отключить SESSION_TIMEOUTS на время транзакции (для создания схемы).
+        """
+        with self._connection(prepare) as conn:
+            with conn.cursor() as cur:
+                if not timeouts:
+                    cur.execute("SET LOCAL statement_timeout = 0; SET LOCAL lock_timeout = 0")
+                yield cur
+            conn.commit()
+
+    def _mark_unhealthy(self, error):
+        """Помечает БД недоступной и запускает фоновую проверку ее восстановления."""
+        with self._health_lock:
+            if not self.healthy:
+                return # Проверка уже запущена
+            self.healthy = False
+        logger.error(f"Database marked unavailable: {error}")
+        threading.Thread(target=self._health_monitor, name="db-health-monitor", daemon=True).start()
+
+    def _health_monitor(self):
+        """Раз в HEALTH_CHECK_INTERVAL секунд выполняет SELECT 1, пока БД снова не ответит."""
+        while True:
+            time.sleep(HEALTH_CHECK_INTERVAL)
+            # Каждая неудачная попытка отбрасывает одно мертвое соединение пула, поэтому пробуем несколько раз подряд
+            for _ in range(POOL_MAX_CONNECTIONS + 1):
+                try:
+                    with self._cursor(prepare=False) as cur:
+                        cur.execute("SELECT 1")
+                except Exception as e:
+                    last_error = e
+                    continue
+                self.healthy = True
+                logger.info("Database is available again.")
+                return
+            logger.warning(f"Database is still unavailable: {last_error}")
+
+    def _listen_for_changes(self):
+        """
+        Фоновый поток: слушает NOTIFY от триггеров и сбрасывает соответствующие кэши.
+        При потере соединения переподключается и сбрасывает кэши целиком (уведомления могли потеряться).
+        """
+        while not self._listener_stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self._connect_params)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {USER_CHANGED_CHANNEL}; LISTEN {COMMON_WORDS_CHANGED_CHANNEL}")
+                self._clear_caches()
+                logger.info("Listening for database change notifications.")
+                while not self._listener_stop.is_set():
+                    if select.select([conn], [], [], HEALTH_CHECK_INTERVAL) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._handle_notification(conn.notifies.pop(0))
+            except Exception as e:
+                if not self._listener_stop.is_set():
+                    logger.warning(f"Database change listener failed, reconnecting: {e}")
+                    self._listener_stop.wait(HEALTH_CHECK_INTERVAL)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+    def _handle_notification(self, notify):
+        """Сбрасывает кэши, затронутые изменением из уведомления notify."""
+        if notify.channel == COMMON_WORDS_CHANGED_CHANNEL:
+            self._reset_common_words()
+            self._stats_cache.clear() # available_words зависит от common_words у всех пользователей
+            return
+        table, _, user_id = notify.payload.partition(':')
+        user_id = int(user_id)
+        if table == 'user_preferences':
+            self._input_modes.invalidate(user_id)
+        elif table == 'user_words':
+            self._user_has_custom.invalidate(user_id)
+            self._invalidate_stats((user_id,))
+
+    def _reset_common_words(self):
+        """Сбрасывает кэш общих слов; он загрузится заново при следующем обращении."""
+        self._common_words_version += 1
+        self._common_words = None
+
+    def _clear_caches(self):
+        """Сбрасывает все кэши, которые обновляются по уведомлениям."""
+        self._reset_common_words()
+        self._input_modes.clear()
+        self._user_has_custom.clear()
+        self._stats_cache.clear()
+
+    def is_healthy(self):
+        """Проверяет, что пул существует и выдает открытое соединение."""
+        if self.pool is None or self.pool.closed:
+            return False
+        try:
+            conn = self.pool.getconn()
+        except Exception as e:
+            logger.error(f"Cannot get connection from pool: {e}")
+            return False
+        healthy = not conn.closed
+        self.pool.putconn(conn, close=not healthy)
+        return healthy
+
+    def _schema_ready(self):
+        """Проверяет, что схема создана и стартовые слова загружены."""
+        with self._cursor(prepare=False) as cur:
+            cur.execute(SCHEMA_READY_QUERY)
+            ready = cur.fetchone()[0]
+            if ready: # Запрос к common_words возможен, только если таблица уже есть
+                cur.execute("SELECT EXISTS (SELECT 1 FROM common_words)")
+                ready = cur.fetchone()[0]
+        return ready
+
+    def _initialize_schema(self):
+        """Создает схему и загружает стартовые слова под advisory lock, чтобы процессы бота не мешали друг другу."""
+        with self._connection(prepare=False) as lock_conn, lock_conn.cursor() as lock_cur:
+            lock_cur.execute("SET LOCAL statement_timeout = 0; SET LOCAL lock_timeout = 0") # Ждем, сколько потребуется
+            lock_cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+            lock_conn.commit() # Блокировка уровня сессии, транзакцию держать не нужно
+            try:
+                if self._schema_ready(): # Схему уже создал другой процесс, пока мы ждали блокировку
+                    logger.info("Database schema was initialized by another process.")
+                    return
+                # Инициализируем все таблицы (включая user_preferences)
+                self.init_tables()
+                logger.info("Table initialization successful.")
+
+                # Загружаем стандартные слова
+                logger.info("Attempting to load/verify initial words...")
+                self.load_initial_words()
+            finally:
+                lock_cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+                lock_conn.commit()
 
     def init_tables(self):
         """Инициализирует таблицы: common_words, user_words, user_word_progress, user_preferences."""
-        if self.conn is None:
+        if self.pool is None:
             logger.error("Cannot initialize tables: Database connection is not established.")
             raise ConnectionError("Database connection is not established.")
 
@@ -95,14 +504,12 @@ class Database:
         ]
         logger.info("Attempting to create/verify tables (common_words, user_words, user_word_progress, user_preferences)...")
         try:
-            with self.conn.cursor() as cur:
+            with self._cursor(prepare=False, timeouts=False) as cur:
                 for command in create_table_commands:
                     if command and command.strip(): # Пропускаем пустые команды
                         cur.execute(command)
-            self.conn.commit()
             logger.info("Tables creation commands committed successfully.")
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"FATAL: Error creating tables: {e}", exc_info=True)
             raise
 
@@ -112,40 +519,94 @@ class Database:
         """
         logger.info("Attempting to add unique constraint 'uq_user_word' to user_words...")
         try:
-            with self.conn.cursor() as cur: cur.execute(add_unique_constraint_command)
-            self.conn.commit()
+            with self._cursor(prepare=False, timeouts=False) as cur:
+                cur.execute(add_unique_constraint_command)
             logger.info("Unique constraint 'uq_user_word' added successfully.")
-        except (psycopg2.errors.DuplicateTable, psycopg2.errors.DuplicateObject) as e:
-            logger.info(f"Unique constraint 'uq_user_word' already exists ({type(e).__name__}). No action needed.")
-            self.conn.rollback()
+        except psycopg2.ProgrammingError as e:
+            if e.pgcode not in (psycopg2.errorcodes.DUPLICATE_OBJECT, psycopg2.errorcodes.DUPLICATE_TABLE):
+                logger.error(f"FATAL: Unexpected error adding constraint 'uq_user_word': {e}", exc_info=True)
+                raise
+            logger.info(f"Unique constraint 'uq_user_word' already exists (pgcode {e.pgcode}). No action needed.")
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"FATAL: Unexpected error adding constraint 'uq_user_word': {e}", exc_info=True)
             raise
 
         # Создание индексов
         create_index_commands = [
-            "CREATE INDEX IF NOT EXISTS idx_user_words_user ON user_words(user_id);",
-            "CREATE INDEX IF NOT EXISTS idx_progress_user_word ON user_word_progress(user_id, word_type, word_ref_id);",
-            "CREATE INDEX IF NOT EXISTS idx_preferences_user ON user_preferences(user_id);" # Для user_preferences
+            # Покрывающие индексы (PostgreSQL 11+): запрос карточки читает слова и прогресс только из индекса
+            "CREATE INDEX IF NOT EXISTS idx_user_words_user_en ON user_words(user_id) INCLUDE (en_word, ru_word, id);",
+            "CREATE INDEX IF NOT EXISTS idx_progress_covering ON user_word_progress(user_id, word_type, word_ref_id) INCLUDE (correct_count, incorrect_count, last_tested);",
+            # Заменены покрывающими индексами выше
+            "DROP INDEX IF EXISTS idx_user_words_user;",
+            "DROP INDEX IF EXISTS idx_progress_user_word;",
+            "DROP INDEX IF EXISTS idx_preferences_user;", # Дублировал первичный ключ user_preferences
         ]
         logger.info("Attempting to create/verify indexes...")
         try:
-            with self.conn.cursor() as cur:
+            with self._cursor(prepare=False, timeouts=False) as cur:
                 for command in create_index_commands:
                     if command and command.strip():
                         cur.execute(command)
-            self.conn.commit()
             logger.info("Indexes ensured and committed successfully.")
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"Warning: Error creating indexes: {e}", exc_info=True)
 
+        # Триггеры NOTIFY для сброса кэшей (CREATE OR REPLACE TRIGGER появился только в PostgreSQL 14)
+        create_trigger_commands = [
+            f"""
+            CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{USER_CHANGED_CHANNEL}', TG_TABLE_NAME || ':' ||
+                    CASE WHEN TG_OP = 'DELETE' THEN OLD.user_id ELSE NEW.user_id END);
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION notify_common_words_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{COMMON_WORDS_CHANGED_CHANNEL}', '');
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql;
+            """,
+            "DROP TRIGGER IF EXISTS trg_user_preferences_notify ON user_preferences;",
+            """
+            CREATE TRIGGER trg_user_preferences_notify AFTER INSERT OR UPDATE OR DELETE ON user_preferences
+            FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+            """,
+            "DROP TRIGGER IF EXISTS trg_user_words_notify ON user_words;",
+            """
+            CREATE TRIGGER trg_user_words_notify AFTER INSERT OR UPDATE OR DELETE ON user_words
+            FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+            """,
+            "DROP TRIGGER IF EXISTS trg_common_words_notify ON common_words;",
+            """
+            CREATE TRIGGER trg_common_words_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON common_words
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_common_words_changed();
+            """,
+        ]
+        logger.info("Attempting to create/verify notification triggers...")
+        try:
+            with self._cursor(prepare=False, timeouts=False) as cur:
+                for command in create_trigger_commands:
+                    cur.execute(command)
+            logger.info("Notification triggers ensured and committed successfully.")
+        except Exception as e:
+            logger.error(f"Warning: Error creating notification triggers: {e}", exc_info=True)
+
         logger.info("Database schema initialization completed successfully.")
 
+    def _prepare_statements(self, conn):
+        """Выполняет PREPARE для запросов из PREPARED_STATEMENTS в соединении conn."""
+        with conn.cursor() as cur:
+            for command in PREPARED_STATEMENTS.values():
+                cur.execute(command)
+        conn.commit()
+        conn.statements_prepared = True
+        logger.debug(f"Prepared {len(PREPARED_STATEMENTS)} statements for a new connection.")
+
     def load_initial_words(self):
         """Загружает стартовый набор слов (или догружает недостающие)"""
-        if self.conn is None:
+        if self.pool is None:
             logger.error("Cannot load initial words: DB connection not established.")
             return False
         default_words = [
@@ -155,21 +616,27 @@ class Database:
         ]
         logger.info(f"Attempting to load/verify {len(default_words)} default words into common_words...")
         try:
-            with self.conn.cursor() as cur:
-                cur.executemany("""
+            with self._cursor(prepare=False, timeouts=False) as cur:
+                # COPY во временную таблицу, затем одна вставка без дубликатов (COPY не поддерживает ON CONFLICT)
+                cur.execute("""
+                    CREATE TEMP TABLE tmp_common_words (en_word VARCHAR(100), ru_word VARCHAR(100)) ON COMMIT DROP
+                """)
+                buf = io.StringIO()
+                csv.writer(buf).writerows(default_words)
+                buf.seek(0)
+                cur.copy_expert("COPY tmp_common_words (en_word, ru_word) FROM STDIN WITH (FORMAT csv)", buf)
+                cur.execute("""
                     INSERT INTO common_words (en_word, ru_word)
-                    VALUES (%s, %s)
+                    SELECT en_word, ru_word FROM tmp_common_words
                     ON CONFLICT (en_word) DO NOTHING
-                """, default_words)
+                """)
                 inserted_count = cur.rowcount
-                self.conn.commit()
             if inserted_count > 0:
                 logger.info(f"Loaded {inserted_count} new default words.")
             else:
                 logger.info("All default words previously existed in common_words.")
             return True
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"Error loading default words: {e}", exc_info=True)
             return False
 
@@ -179,83 +646,43 @@ class Database:
         Приоритет: Новые слова > Слова с ошибками > Правильно отвеченные слова.
         Возвращает en_word, ru_word, options, word_type, word_ref_id.
         """
-        if self.conn is None:
+        if self.pool is None:
             logger.error("Cannot get random card: DB connection not established.")
             return None
         try:
-            with self.conn.cursor() as cur:
-                # 1. Получаем ВСЕ доступные слова пользователя ВМЕСТЕ с их прогрессом
-                sql = """
-                    SELECT
-                        w.en_word, w.ru_word, w.word_type, w.word_ref_id,
-                        p.correct_count, p.incorrect_count
-                    FROM (
-                        SELECT en_word, ru_word, 'common' AS word_type, id AS word_ref_id FROM common_words
-                        UNION
-                        SELECT en_word, ru_word, 'user' AS word_type, id AS word_ref_id FROM user_words WHERE user_id = %(user_id)s
-                    ) AS w
-                    LEFT JOIN user_word_progress p ON w.word_ref_id = p.word_ref_id
-                                                   AND w.word_type = p.word_type
-                                                   AND p.user_id = %(user_id)s
-                """
-                cur.execute(sql, {'user_id': user_id})
-                words_data_with_progress = cur.fetchall()
-
-                if not words_data_with_progress:
-                    logger.info(f"No words found for user {user_id} to select a card from.")
-                    return None
-
-                # 2. Рассчитываем веса
-                population = []
-                weights = []
-                for row in words_data_with_progress:
-                    en_word, ru_word, word_type, word_ref_id, correct_c, incorrect_c = row
-                    word_info = {'en_word': en_word, 'ru_word': ru_word, 'word_type': word_type, 'word_ref_id': word_ref_id}
-                    population.append(word_info)
-                    correct_count = correct_c if correct_c is not None else 0
-                    incorrect_count = incorrect_c if incorrect_c is not None else 0
-                    weight = 1
-                    if correct_count == 0 and incorrect_count == 0: weight = 10
-                    elif incorrect_count > 0: weight = 5 + incorrect_count * 2 - correct_count
-                    elif correct_count > 0: weight = max(1, 5 - correct_count)
-                    final_weight = max(1, weight)
-                    weights.append(final_weight)
-
-                if not population:
-                     logger.error(f"Word population is empty after processing for user {user_id}")
-                     return None
-                if len(population) != len(weights):
-                     logger.error(f"Mismatch population/weights count for user {user_id}. Fallback to random.")
-                     selected_word_info = random.choice(population)
+            with self._cursor() as cur:
+                # 1. Выбираем слово с учетом весов и варианты ответа прямо в БД
+                if self._has_custom_words(cur, user_id):
+                    statement = 'get_random_card'
                 else:
-                    # 3. Выполняем взвешенный случайный выбор
-                    try:
-                         logger.debug(f"Weights for user {user_id}: {list(zip([p['en_word'] for p in population], weights))}")
-                         selected_word_info = random.choices(population=population, weights=weights, k=1)[0]
-                    except ValueError as ve:
-                         logger.error(f"Error during weighted choice for user {user_id}: {ve}. Fallback to random.")
-                         selected_word_info = random.choice(population)
-
-                # 4. Формируем варианты ответов
-                target_en_word = selected_word_info['en_word']
-                all_available_en_words = [row[0] for row in words_data_with_progress]
-                other_en_words = [w for w in all_available_en_words if w != target_en_word]
-                num_options = min(3, len(other_en_words))
-                options = random.sample(other_en_words, num_options) + [target_en_word]
-                random.shuffle(options)
-
-                # 5. Возвращаем результат
-                return {
-                    'en_word': selected_word_info['en_word'],
-                    'ru_word': selected_word_info['ru_word'],
-                    'options': options,
-                    'word_type': selected_word_info['word_type'],
-                    'word_ref_id': selected_word_info['word_ref_id']
-                }
+                    statement = 'get_random_common_card'
+                    common_words = self._get_common_words(cur)
+                cur.execute(f"EXECUTE {statement}(%s)", (user_id,))
+                selected = cur.fetchone()
+            if selected is None:
+                logger.info(f"No words found for user {user_id} to select a card from.")
+                return None
+            if statement == 'get_random_card':
+                en_word, ru_word, word_type, word_ref_id, options = selected
+            else:
+                en_word, ru_word, word_type, word_ref_id = selected
+                # Четырех случайных общих слов хватает на три варианта, даже если среди них есть правильный
+                options = [w for w in random.sample(common_words, min(4, len(common_words))) if w != en_word][:3]
+
+            # 2. Добавляем правильный ответ к неправильным и перемешиваем
+            options.append(en_word)
+            random.shuffle(options)
+
+            # 3. Возвращаем результат
+            return {
+                'en_word': en_word,
+                'ru_word': ru_word,
+                'options': options,
+                'word_type': word_type,
+                'word_ref_id': word_ref_id
+            }
         except psycopg2.Error as db_err:
              logger.error(f"Database error getting weighted card for user {user_id}: {db_err}", exc_info=True)
-             try: self.conn.rollback()
-             except Exception as rb_err: logger.error(f"Error during rollback: {rb_err}")
              return None
         except Exception as e:
             logger.error(f"Unexpected error getting weighted card for user {user_id}: {e}", exc_info=True)
@@ -263,103 +690,151 @@ class Database:
 
     def add_user_word(self, user_id, en_word, ru_word):
         """Добавляет пользовательское слово."""
-        if self.conn is None: return False
+        if self.pool is None: return False
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO user_words (user_id, en_word, ru_word)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (user_id, en_word) DO NOTHING
-                    RETURNING id
-                """, (user_id, en_word.lower(), ru_word.lower()))
+            with self._cursor() as cur:
+                cur.execute("EXECUTE add_user_word(%s, %s, %s)", (user_id, en_word.lower(), ru_word.lower()))
                 result = cur.fetchone()
-                inserted = result is not None
-                self.conn.commit()
-                logger.info(f"Add word '{en_word}' for user {user_id}: {'Success' if inserted else 'Already exists'}")
-                return inserted
+            inserted = result is not None
+            if inserted:
+                self._invalidate_stats((user_id,))
+                self._user_has_custom.set(user_id, True)
+            logger.info(f"Add word '{en_word}' for user {user_id}: {'Success' if inserted else 'Already exists'}")
+            return inserted
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"Error adding word '{en_word}' for user {user_id}: {e}", exc_info=True)
             return False
 
     def delete_user_word(self, user_id, en_word):
         """Удаляет пользовательское слово И связанную с ним статистику."""
-        if self.conn is None: return False
-        word_id_to_delete = None
+        if self.pool is None: return False
         en_word_lower = en_word.lower()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT id FROM user_words WHERE user_id = %s AND en_word = %s", (user_id, en_word_lower))
-                result = cur.fetchone()
-                if not result:
-                    logger.warning(f"Word '{en_word}' not found for user {user_id} to delete.")
-                    return False
-                word_id_to_delete = result[0]
-                cur.execute(
-                    "DELETE FROM user_word_progress WHERE user_id = %s AND word_type = 'user' AND word_ref_id = %s",
-                    (user_id, word_id_to_delete)
-                )
-                progress_deleted_count = cur.rowcount
-                cur.execute("DELETE FROM user_words WHERE id = %s", (word_id_to_delete,))
-                deleted_count = cur.rowcount
-            self.conn.commit()
-            logger.info(f"Deleted word '{en_word}' (id: {word_id_to_delete}), its progress ({progress_deleted_count} rows) for user {user_id}. Success: {deleted_count > 0}")
-            return deleted_count > 0
+            with self._cursor() as cur:
+                # Слово и его прогресс удаляются одним запросом
+                cur.execute("""
+                    WITH deleted AS (
+                        DELETE FROM user_words WHERE user_id = %(user_id)s AND en_word = %(en_word)s
+                        RETURNING id
+                    ), deleted_progress AS (
+                        DELETE FROM user_word_progress p USING deleted d
+                        WHERE p.user_id = %(user_id)s AND p.word_type = 'user' AND p.word_ref_id = d.id
+                        RETURNING p.id
+                    )
+                    SELECT (SELECT id FROM deleted), (SELECT COUNT(*) FROM deleted_progress)
+                """, {'user_id': user_id, 'en_word': en_word_lower})
+                word_id_to_delete, progress_deleted_count = cur.fetchone()
+            if word_id_to_delete is None:
+                logger.warning(f"Word '{en_word}' not found for user {user_id} to delete.")
+                return False
+            with self._answer_lock: # Не даем буферу ответов воссоздать прогресс удаленного слова
+                self._answer_buf.pop((user_id, 'user', word_id_to_delete), None)
+            self._invalidate_stats((user_id,))
+            self._user_has_custom.invalidate(user_id) # Могли остаться другие слова
+            logger.info(f"Deleted word '{en_word}' (id: {word_id_to_delete}), its progress ({progress_deleted_count} rows) for user {user_id}.")
+            return True
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"Error deleting word '{en_word}' for user {user_id}: {e}", exc_info=True)
             return False
 
     def record_answer(self, user_id, word_type, word_ref_id, is_correct):
-        """Записывает результат ответа пользователя в user_word_progress."""
-        if self.conn is None: return False
+        """
+        Добавляет результат ответа в буфер. Ответы на одно и то же слово складываются,
+        буфер записывается в user_word_progress по таймеру или при заполнении (см. flush_answers).
+        """
+        if self.pool is None: return False
+        key = (user_id, word_type, word_ref_id)
+        with self._answer_lock:
+            correct_delta, incorrect_delta = self._answer_buf.get(key, (0, 0))
+            if is_correct: correct_delta += 1
+            else: incorrect_delta += 1
+            self._answer_buf[key] = (correct_delta, incorrect_delta)
+            flush_now = len(self._answer_buf) >= ANSWER_FLUSH_SIZE
+            if not flush_now and self._flush_timer is None:
+                self._flush_timer = threading.Timer(ANSWER_FLUSH_INTERVAL, self.flush_answers)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        self._invalidate_stats((user_id,))
+        logger.debug("Buffered answer for user %s, word %s/%s, correct: %s", user_id, word_type, word_ref_id, is_correct)
+        if flush_now:
+            self.flush_answers()
+        return True
+
+    def flush_answers(self):
+        """Записывает накопленные в буфере ответы одним запросом."""
+        with self._answer_lock:
+            deltas, self._answer_buf = self._answer_buf, {}
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if deltas and not self._write_answer_deltas(deltas):
+            logger.error(f"Failed to flush {len(deltas)} buffered answers, they are lost.")
+
+    def _write_answer_deltas(self, deltas):
+        """Прибавляет приращения {(user_id, word_type, word_ref_id): (верные, ошибки)} к прогрессу."""
+        if self.pool is None: return False
+        rows = [key + value for key, value in deltas.items()]
         try:
-            with self.conn.cursor() as cur:
-                now_utc = datetime.now(timezone.utc)
-                if is_correct:
-                    update_sql = """
-                    INSERT INTO user_word_progress (user_id, word_type, word_ref_id, correct_count, incorrect_count, last_tested)
-                    VALUES (%s, %s, %s, 1, 0, %s)
-                    ON CONFLICT (user_id, word_type, word_ref_id) DO UPDATE SET
-                        correct_count = user_word_progress.correct_count + 1, last_tested = EXCLUDED.last_tested;
-                    """
-                else:
-                    update_sql = """
-                    INSERT INTO user_word_progress (user_id, word_type, word_ref_id, correct_count, incorrect_count, last_tested)
-                    VALUES (%s, %s, %s, 0, 1, %s)
-                    ON CONFLICT (user_id, word_type, word_ref_id) DO UPDATE SET
-                        incorrect_count = user_word_progress.incorrect_count + 1, last_tested = EXCLUDED.last_tested;
-                    """
-                cur.execute(update_sql, (user_id, word_type, word_ref_id, now_utc))
-                self.conn.commit()
-                logger.debug(f"Recorded answer for user {user_id}, word {word_type}/{word_ref_id}, correct: {is_correct}")
-                return True
+            with self._cursor() as cur:
+                cur.execute("EXECUTE record_answers(%s, %s, %s, %s, %s)", [list(column) for column in zip(*rows)])
+            self._invalidate_stats({user_id for user_id, _, _ in deltas})
+            logger.debug(f"Recorded {len(rows)} progress rows")
+            return True
         except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Error recording answer for user {user_id}, word {word_type}/{word_ref_id}: {e}", exc_info=True)
+            logger.error(f"Error recording {len(rows)} progress rows: {e}", exc_info=True)
             return False
 
-    def get_user_stats(self, user_id):
-        """Получает общую статистику пользователя."""
-        if self.conn is None: return {'total_correct': 0, 'total_incorrect': 0, 'words_practiced': 0}
+    def get_stats_bundle(self, user_id):
+        """
+        Получает статистику ответов и количество слов пользователя одним запросом.
+        Результат кэшируется на STATS_CACHE_TTL секунд и сбрасывается при изменении слов или прогресса пользователя.
+        """
+        empty = {'total_correct': 0, 'total_incorrect': 0, 'words_practiced': 0, 'user_words': 0, 'available_words': 0}
+        if self.pool is None: return empty
+        cached = self._stats_cache.get(user_id)
+        if cached is not None:
+            return dict(cached) # Копия: вызывающий код может дополнять словарь
         try:
-            with self.conn.cursor() as cur:
+            read_id = self._stats_cache.begin_read()
+            with self._cursor() as cur:
                  cur.execute("""
-                    SELECT COALESCE(SUM(correct_count), 0), COALESCE(SUM(incorrect_count), 0), COUNT(*)
-                    FROM user_word_progress WHERE user_id = %s
-                """, (user_id,))
-                 stats = cur.fetchone()
-                 return {'total_correct': stats[0], 'total_incorrect': stats[1], 'words_practiced': stats[2]}
+                    SELECT
+                        p.total_correct, p.total_incorrect, p.words_practiced,
+                        (SELECT COUNT(*) FROM user_words WHERE user_id = %(user_id)s),
+                        (SELECT COUNT(DISTINCT en_word) FROM (
+                            SELECT en_word FROM common_words
+                            UNION ALL
+                            SELECT en_word FROM user_words WHERE user_id = %(user_id)s
+                        ) AS all_words)
+                    FROM (
+                        SELECT COALESCE(SUM(correct_count), 0) AS total_correct,
+                               COALESCE(SUM(incorrect_count), 0) AS total_incorrect,
+                               COUNT(*) AS words_practiced
+                        FROM user_word_progress WHERE user_id = %(user_id)s
+                    ) AS p
+                """, {'user_id': user_id})
+                 row = cur.fetchone()
+            stats = dict(zip(empty, row))
+            self._stats_cache.store_read(user_id, stats, read_id) # Не сохраняет статистику, сброшенную во время запроса
+            return dict(stats)
         except Exception as e:
-            logger.error(f"Error getting stats for user {user_id}: {e}", exc_info=True)
-            return {'total_correct': 0, 'total_incorrect': 0, 'words_practiced': 0}
+            logger.error(f"Error getting stats bundle for user {user_id}: {e}", exc_info=True)
+            return empty
 
-    def get_user_words(self, user_id):
-        """Возвращает список слов (en_word, ru_word), добавленных пользователем."""
-        if self.conn is None: return []
+    def _invalidate_stats(self, user_ids):
+        """Удаляет статистику пользователей из кэша (после изменения их слов или прогресса)."""
+        for user_id in user_ids:
+            self._stats_cache.invalidate(user_id)
+
+    def get_user_words(self, user_id, limit=None, offset=0):
+        """Возвращает список слов (en_word, ru_word), добавленных пользователем. limit=None - без ограничения."""
+        if self.pool is None: return []
         try:
-            with self.conn.cursor() as cur:
-                 cur.execute("SELECT en_word, ru_word FROM user_words WHERE user_id = %s ORDER BY en_word", (user_id,))
+            with self._cursor() as cur:
+                 cur.execute(
+                     "SELECT en_word, ru_word FROM user_words WHERE user_id = %s ORDER BY en_word LIMIT %s OFFSET %s",
+                     (user_id, limit, offset)
+                 )
                  user_words = cur.fetchall()
                  logger.debug(f"Retrieved {len(user_words)} words for user {user_id}")
                  return user_words
@@ -369,75 +844,101 @@ class Database:
 
     def count_total_words(self, user_id):
         """Считает общее количество УНИКАЛЬНЫХ английских слов, доступных пользователю."""
-        if self.conn is None: return 0
+        if self.pool is None: return 0
         try:
-            with self.conn.cursor() as cur:
-                 cur.execute("""
-                    SELECT COUNT(DISTINCT en_word) FROM (
-                        SELECT en_word FROM common_words
-                        UNION
-                        SELECT en_word FROM user_words WHERE user_id = %s
-                    ) AS all_words
-                """, (user_id,))
-                 count = cur.fetchone()[0]
-                 logger.debug(f"Total unique words count for user {user_id}: {count}")
-                 return count
+            common_words = self._common_words
+            if self._user_has_custom.get(user_id) is False and common_words is not None:
+                count = len(common_words) # Доступны только общие слова, и они уже в памяти
+            else:
+                with self._cursor() as cur:
+                    if self._has_custom_words(cur, user_id):
+                        cur.execute("EXECUTE count_total_words(%s)", (user_id,))
+                        count = cur.fetchone()[0]
+                    else:
+                        count = len(self._get_common_words(cur))
+            logger.debug(f"Total unique words count for user {user_id}: {count}")
+            return count
         except Exception as e:
             logger.error(f"Error counting total words for user {user_id}: {e}", exc_info=True)
             return 0
 
+    def _has_custom_words(self, cur, user_id):
+        """Есть ли у пользователя свои слова. Значение кэшируется на USER_WORDS_FLAG_TTL секунд."""
+        cached = self._user_has_custom.get(user_id)
+        if cached is not None:
+            return cached
+        read_id = self._user_has_custom.begin_read()
+        cur.execute("EXECUTE has_user_words(%s)", (user_id,))
+        has_custom = cur.fetchone()[0]
+        self._user_has_custom.store_read(user_id, has_custom, read_id) # Не затирает признак, измененный во время запроса
+        return has_custom
+
+    def _get_common_words(self, cur):
+        """Возвращает en_word всех общих слов, загружая их в память при первом обращении."""
+        common_words = self._common_words
+        if common_words is None:
+            version = self._common_words_version
+            cur.execute("EXECUTE get_common_words")
+            common_words = tuple(row[0] for row in cur.fetchall())
+            if version == self._common_words_version: # Кэш не сбросили, пока шел запрос
+                self._common_words = common_words
+        return common_words
+
     # --- Функции для настроек режима ввода ---
 
     def get_user_input_mode(self, user_id):
-        """Получает режим ввода пользователя. Возвращает 'buttons' или 'keyboard'."""
-        if self.conn is None:
+        """Получает режим ввода пользователя (с кэшем на INPUT_MODE_CACHE_TTL секунд). Возвращает 'buttons' или 'keyboard'."""
+        if self.pool is None:
             logger.error("Cannot get user input mode: DB connection lost.")
             return 'buttons' # Дефолт при ошибке
+        cached = self._input_modes.get(user_id)
+        if cached is not None:
+            return cached
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT input_mode FROM user_preferences WHERE user_id = %s", (user_id,))
+            read_id = self._input_modes.begin_read()
+            with self._cursor() as cur:
+                cur.execute("EXECUTE get_user_input_mode(%s)", (user_id,))
                 result = cur.fetchone()
-                return result[0] if result else 'buttons' # Дефолт, если записи нет
+            mode = result[0] if result else 'buttons' # Дефолт, если записи нет
+            self._input_modes.store_read(user_id, mode, read_id) # Не затирает режим, установленный во время запроса
+            return mode
         except Exception as e:
             logger.error(f"Error getting input mode for user {user_id}: {e}", exc_info=True)
             return 'buttons' # Дефолт при ошибке
 
     def set_user_input_mode(self, user_id, mode):
         """Устанавливает режим ввода для пользователя ('buttons' или 'keyboard')."""
-        if self.conn is None: return False
+        if self.pool is None: return False
         if mode not in ('buttons', 'keyboard'): return False
         try:
-            with self.conn.cursor() as cur:
-                sql = """
-                    INSERT INTO user_preferences (user_id, input_mode) VALUES (%s, %s)
-                    ON CONFLICT (user_id) DO UPDATE SET input_mode = EXCLUDED.input_mode;
-                """
-                cur.execute(sql, (user_id, mode))
-                self.conn.commit()
-                logger.info(f"Set input mode to '{mode}' for user {user_id}")
-                return True
+            with self._cursor() as cur:
+                cur.execute("EXECUTE set_user_input_mode(%s, %s)", (user_id, mode))
+            self._input_modes.set(user_id, mode)
+            logger.info(f"Set input mode to '{mode}' for user {user_id}")
+            return True
         except Exception as e:
-            self.conn.rollback()
             logger.error(f"Error setting input mode for user {user_id}: {e}", exc_info=True)
             return False
 
-    def close(self):
-        """Закрывает соединение с базой"""
-        if self.conn and not self.conn.closed:
+    def close_all(self):
+        """Записывает буфер ответов и закрывает все соединения пула"""
+        self._listener_stop.set()
+        if self.pool and not self.pool.closed:
+            self.flush_answers()
             try:
-                 self.conn.close()
-                 logger.info("Database connection closed.")
+                 self.pool.closeall()
+                 logger.info("Database connection pool closed.")
             except Exception as e:
-                 logger.error(f"Error closing database connection: {e}", exc_info=True)
-        elif self.conn is None:
-             logger.warning("Attempted to close a non-existent database connection.")
+                 logger.error(f"Error closing database connection pool: {e}", exc_info=True)
+        elif self.pool is None:
+             logger.warning("Attempted to close a non-existent database connection pool.")
 
 # --- Инициализация глобального объекта базы данных ---
 db = None
 try:
     db = Database()
-    if db.conn is None:
-        raise ConnectionError("DB object created, but connection is None.")
+    if db.pool is None:
+        raise ConnectionError("DB object created, but connection pool is None.")
 except Exception as global_db_error:
     logger.critical(f"FATAL: Failed to initialize the Database object or connection: {global_db_error}", exc_info=True)
     raise # Пробрасываем, чтобы bot.py не запустился
\ No newline at end of file